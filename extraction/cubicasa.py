@@ -1,19 +1,23 @@
 from collections import namedtuple
-from functools import cached_property
-from io import StringIO
-from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+from functools import cached_property, partial
+from io import BytesIO
+from itertools import chain, islice
 import math
+import mmap
+from operator import attrgetter
 import os.path
 import re
 
-from shapely.geometry import LineString, MultiLineString, MultiPolygon, Point, Polygon
+from shapely.geometry import LineString, MultiLineString, MultiPolygon, Point, Polygon, box
+from shapely.geometry.base import BaseMultipartGeometry
 from shapely.ops import polygonize, split
+from shapely.strtree import STRtree
 import svgelements
 
 
-id_pattern = re.compile("\s+id=\".*?\"", re.IGNORECASE)
-display_none_pattern = re.compile("display\s*:\s*none\s*;", re.IGNORECASE)
-whitespace = re.compile("\s+")
+id_pattern = re.compile(rb"\s+id=\".*?\"", re.IGNORECASE)
+display_none_pattern = re.compile(rb"display\s*:\s*none\s*;", re.IGNORECASE)
 
 CLOSE_EDGE_TOLERANCE = 1.0
 ROOM_TYPES = [
@@ -92,32 +96,51 @@ def simplify_fixture_type(classes):
     else:
         t = classes[0]
 
-    t = re.sub(fixture_type_prefixes, "", t)
-    t = re.sub(fixture_type_suffixes, "", t)
+    t = fixture_type_prefixes.sub("", t)
+    t = fixture_type_suffixes.sub("", t)
     return t if t in FIXTURE_TYPES else "Other"
 
 
 def get_classes(element):
     if svgelements.SVG_ATTR_CLASS in element.values:
-        class_str = element.values[svgelements.SVG_ATTR_CLASS]
-        return re.split(whitespace, class_str.strip())
+        return element.values[svgelements.SVG_ATTR_CLASS].split()
     else:
         return []
 
 
+def point_segment_distance(point, start, end):
+    """Returns the distance from a point to the line segment between start and end."""
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    length_squared = dx * dx + dy * dy
+    if length_squared == 0:
+        return math.dist(point, start)
+
+    # Project the point onto the segment, clamping to the segment's endpoints
+    t = ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / length_squared
+    t = max(0, min(1, t))
+    return math.dist(point, (start[0] + t * dx, start[1] + t * dy))
+
 def lines_are_close(line1, line2, tolerance):
-    if line1.length > 0 and line2.length > 0:
+    """Returns true if at least two endpoints of the lines are within the tolerance of the other line.
+
+    Each line is given as a pair of endpoint coordinates.
+    """
+    start1, end1 = line1
+    start2, end2 = line2
+
+    if start1 != end1 and start2 != end2:
 
         first_pair_found = False
         pairs = [
-            (line1, line2.boundary[0]),
-            (line1, line2.boundary[1]),
-            (line2, line1.boundary[0]),
-            (line2, line1.boundary[1])
+            (line1, start2),
+            (line1, end2),
+            (line2, start1),
+            (line2, end1)
         ]
 
-        for edge, point in pairs:
-            if edge.distance(point) < tolerance:
+        for (start, end), point in pairs:
+            if point_segment_distance(point, start, end) < tolerance:
                 if first_pair_found:
                     return True
                 else:
@@ -125,29 +148,42 @@ def lines_are_close(line1, line2, tolerance):
 
     return False
 
+def bounds_distance(bounds1, bounds2):
+    """Returns the distance between two bounding boxes, which is zero if they intersect or infinite if either is empty."""
+    if len(bounds1) == 0 or len(bounds2) == 0:
+        return math.inf
+
+    dx = max(bounds1[0] - bounds2[2], bounds2[0] - bounds1[2], 0)
+    dy = max(bounds1[1] - bounds2[3], bounds2[1] - bounds1[3], 0)
+    return math.hypot(dx, dy)
+
 def polygon_edges(polygon):
     a = polygon.exterior.coords[:-1]
     b = polygon.exterior.coords[1:]
     return [LineString(points) for points in zip(a, b)]
 
 def largest_polygon(polygons):
-    largest = polygons[0]
-    for p in polygons[1:]:
-        if p.area > largest.area:
-            largest = p
-    return largest
+    return max(polygons, key=attrgetter("area"))
 
-def extend_or_append(list, iterable_or_not):
-    try:
-        list.extend(iterable_or_not)
-    except:
-        list.append(iterable_or_not)
+def extend_or_append(list, geometry):
+    if isinstance(geometry, BaseMultipartGeometry):
+        list.extend(geometry.geoms)
+    else:
+        list.append(geometry)
 
 def split_at_intersections(edges):
+    tree = STRtree(edges)
     split_edges = []
 
     for this_edge in edges:
-        other_edges = MultiLineString([e for e in edges if e != this_edge])
+
+        # Only edges whose bounding boxes touch this one can split it
+        nearby_edges = [e for e in tree.query(this_edge) if e != this_edge]
+        if len(nearby_edges) == 0:
+            split_edges.append(this_edge)
+            continue
+
+        other_edges = MultiLineString(nearby_edges)
 
         try:
             result = split(this_edge, other_edges)
@@ -161,20 +197,15 @@ def split_at_intersections(edges):
 
     return split_edges
 
-def remove_duplicates(geometry_list):
-    deduplicated = []
+def remove_duplicates(lines):
+    """Returns the given lines with duplicates removed, treating a line and its reverse as the same line."""
+    deduplicated = {}
 
-    for this in geometry_list:
-        has_duplicate = False
-        for that in deduplicated:
-            if this.equals(that):
-                has_duplicate = True
-                break
+    for line in lines:
+        coords = tuple(line.coords)
+        deduplicated.setdefault(min(coords, coords[::-1]), line)
 
-        if not has_duplicate:
-            deduplicated.append(this)
-
-    return deduplicated
+    return list(deduplicated.values())
 
 def polygon_from_points(points):
     num_points = len(points)
@@ -207,6 +238,9 @@ def polygon_from_points(points):
 
 class PlanObject:
 
+    # __dict__ is kept so the cached properties still have somewhere to store their values
+    __slots__ = ("container", "index", "adjacencies", "__dict__")
+
     def __init__(self, container, index):
         self.container = container
         self.index = index
@@ -215,20 +249,37 @@ class PlanObject:
     def __repr__(self):
         return "{} {}".format(self.__class__.__name__, self.index)
 
+    @cached_property
+    def _classes(self):
+        return get_classes(self.container)
+
     @property
     def polygon_element(self):
         return self.container[0]
 
     @cached_property
     def polygon(self):
-        points = [Point(p.x, p.y) for p in self.polygon_element.points]
+        points = [(p.x, p.y) for p in self.polygon_element.points]
         return polygon_from_points(points)
 
     def num_edges(self):
-        return len(self.polygon.exterior.coords) - 1
+        return len(self.edges)
+
+    @cached_property
+    def bounds(self):
+        return self.polygon.bounds
+
+    @cached_property
+    def coords(self):
+        return tuple(self.polygon.exterior.coords)
+
+    @cached_property
+    def edge_coords(self):
+        return tuple(zip(self.coords[:-1], self.coords[1:]))
 
+    @cached_property
     def edges(self):
-        return polygon_edges(self.polygon)
+        return tuple(LineString(points) for points in self.edge_coords)
 
     def add_adjacency(self, object, intersection):
         self.adjacencies.add(object, intersection)
@@ -245,15 +296,30 @@ class PlanObject:
 
     def _is_close(self, other):
         """Returns true if there is at least one pair of close edges between the two objects."""
+
+        # The polygons can't be any closer than their bounding boxes
+        if bounds_distance(self.bounds, other.bounds) > CLOSE_EDGE_TOLERANCE:
+            return False
+
         d = self.polygon.distance(other.polygon)
         if d <= CLOSE_EDGE_TOLERANCE:
-            for self_edge in self.edges():
-                for other_edge in other.edges():
+
+            # An edge can only be part of a close pair if it comes within the tolerance of the other polygon
+            self_edges = self._edges_near(other)
+            other_edges = other._edges_near(self)
+
+            for self_edge in self_edges:
+                for other_edge in other_edges:
                     if lines_are_close(self_edge, other_edge, CLOSE_EDGE_TOLERANCE):
                         return True
 
         return False
 
+    def _edges_near(self, other):
+        """Returns the endpoint coordinates of each edge within the tolerance of the other object."""
+        edges = zip(self.edges, self.edge_coords)
+        return [coords for edge, coords in edges if edge.distance(other.polygon) < CLOSE_EDGE_TOLERANCE]
+
 
     def adjacencies_by_type(self, cls):
         return list(filter(lambda obj: isinstance(obj, cls), self.adjacencies.keys()))
@@ -272,9 +338,9 @@ class AdjacencyList(dict):
     def filter(self, fn):
         matches = AdjacencyList()
         for object, info_list in self.items():
-            for info_item in info_list:
-                if fn(object, info_item):
-                    matches.add(object, info_item)
+            kept = [info_item for info_item in info_list if fn(object, info_item)]
+            if len(kept) > 0:
+                matches[object] = kept
         return matches
 
 
@@ -282,6 +348,8 @@ class AdjacencyList(dict):
 
 class Room(PlanObject):
 
+    __slots__ = ("doors", "windows", "fixtures")
+
     def __init__(self, container, index):
         super().__init__(container, index)
         self.doors = set()
@@ -293,8 +361,7 @@ class Room(PlanObject):
 
     @cached_property
     def types(self):
-        classes = get_classes(self.container)
-        return classes[1:] if len(classes) > 1 else []
+        return self._classes[1:]
 
     @property
     def full_type(self):
@@ -350,7 +417,9 @@ class Divider(PlanObject):
     @property
     def eligible_edges_with_indexes(self):
         """Returns a list of edges that are eligible for adjacency checks along with their indexes in the main edges list."""
-        return list(map(lambda e: (self.edges.index(e), e), self.eligible_edges))
+        if len(self.edges) == 4:
+            return [(0, self.edges[0]), (2, self.edges[2])]
+        return []
 
     def rooms_opposite(self, room):
         """Returns a list of rooms adjacent to the opposite side of the wall/railing from the given room."""
@@ -367,6 +436,8 @@ class Railing(Divider):
 
 class Wall(Divider):
 
+    __slots__ = ("openings", "_polygon")
+
     def __init__(self, container, index):
         super().__init__(container, index)
         self.openings = []
@@ -374,7 +445,8 @@ class Wall(Divider):
 
         for child in container:
             if isinstance(child, svgelements.Group):
-                object_type = get_classes(child)[0]
+                classes = get_classes(child)
+                object_type = classes[0] if classes else ""
                 if object_type == "Door":
                     self.openings.append(Door(self, child, len(self.openings)))
                 elif object_type == "Window":
@@ -382,13 +454,21 @@ class Wall(Divider):
 
     @property
     def polygon(self):
-        if self._polygon == None:
+        if self._polygon is None:
             self._polygon = super().polygon
         return self._polygon
 
+    @polygon.setter
+    def polygon(self, polygon):
+        self._polygon = polygon
+
+        # Discard the cached bounds, coordinates and edges of the old polygon
+        for name in ("bounds", "coords", "edge_coords", "edges"):
+            self.__dict__.pop(name, None)
+
     @property
     def is_exterior(self):
-        return "External" in get_classes(self.container)
+        return "External" in self._classes
 
     def add_adjacency(self, object, intersection):
         super().add_adjacency(object, intersection)
@@ -402,20 +482,23 @@ class Wall(Divider):
 
             self_difference = subtract_cleanly(self.polygon, other_wall.polygon, CLOSE_EDGE_TOLERANCE)
             if self_difference is not None:
-                self._polygon = self_difference
+                self.polygon = self_difference
                 return True
 
             other_difference = subtract_cleanly(other_wall.polygon, self.polygon, CLOSE_EDGE_TOLERANCE)
             if other_difference is not None:
-                other_wall._polygon = other_difference
+                other_wall.polygon = other_difference
                 return True
 
             if clean_overlaps_only:
                 return False
 
-            other_wall._polygon = other_difference
+            other_wall.polygon = other_difference
             return True
 
+        # The walls don't overlap, so there's nothing to remove
+        return True
+
 
 def subtract_cleanly(this_polygon, that_polygon, tolerance):
     difference = this_polygon.difference(that_polygon)
@@ -431,15 +514,17 @@ def subtract_cleanly(this_polygon, that_polygon, tolerance):
 
 def minimum_rotated_rectangle_dimension(polygon):
     rect = polygon.minimum_rotated_rectangle
-    points = [Point(c) for c in rect.exterior.coords[:3]]
-    d1 = points[0].distance(points[1])
-    d2 = points[1].distance(points[2])
+    points = rect.exterior.coords[:3]
+    d1 = math.dist(points[0], points[1])
+    d2 = math.dist(points[1], points[2])
     return min(d1, d2)
 
 
 
 class WallOpening(PlanObject):
 
+    __slots__ = ("wall", "rooms")
+
     def __init__(self, wall, container, index):
         super().__init__(container, index)
         self.wall = wall
@@ -472,6 +557,8 @@ class Window(WallOpening):
 
 class Fixture(PlanObject):
 
+    __slots__ = ("rooms",)
+
     def __init__(self, container, index):
         super().__init__(container, index)
         self.rooms = set()
@@ -505,10 +592,10 @@ class Fixture(PlanObject):
 
             if isinstance(e, svgelements.Rect):
                 return Polygon([
-                    Point(e.x, e.y),
-                    Point(e.x + e.width, e.y),
-                    Point(e.x + e.width, e.y + e.height),
-                    Point(e.x, e.y + e.height)
+                    (e.x, e.y),
+                    (e.x + e.width, e.y),
+                    (e.x + e.width, e.y + e.height),
+                    (e.x, e.y + e.height)
                 ])
 
             if isinstance(e, svgelements.Circle):
@@ -529,8 +616,7 @@ class Fixture(PlanObject):
 
     @cached_property
     def types(self):
-        classes = get_classes(self.container)
-        return classes[1:] if len(classes) > 1 else []
+        return self._classes[1:]
 
     @property
     def full_type(self):
@@ -584,6 +670,29 @@ def find_children_by_class(parent, class_name):
         return []
 
 
+class PlanObjectIndex:
+    """A spatial index for finding plan objects whose bounding boxes intersect a given geometry."""
+
+    def __init__(self, objects):
+        self.tree = STRtree([object.polygon for object in objects])
+        self.objects_by_polygon = {id(object.polygon): (position, object) for position, object in enumerate(objects)}
+
+    def query(self, geometry, distance=0):
+        """Returns the indexed objects whose bounding boxes come within the distance of the geometry's bounding box.
+
+        Objects are returned in the order they were given to the index.
+        """
+        if geometry.is_empty:
+            return []
+
+        if distance > 0:
+            min_x, min_y, max_x, max_y = geometry.bounds
+            geometry = box(min_x - distance, min_y - distance, max_x + distance, max_y + distance)
+
+        matches = sorted(self.objects_by_polygon[id(polygon)] for polygon in self.tree.query(geometry))
+        return [object for position, object in matches]
+
+
 class PlanObjectList(list):
 
     def __init__(self, object_class, *args, **kwargs):
@@ -619,7 +728,8 @@ class Floor:
 
         for child in plan:
             if isinstance(child, svgelements.Group):
-                object_type = get_classes(child)[0]
+                classes = get_classes(child)
+                object_type = classes[0] if classes else ""
 
                 if object_type == "Space":
                     self.rooms.add(child)
@@ -639,34 +749,44 @@ class Floor:
 
     def area(self):
         """Returns the total area of the floor."""
-        area = 0
+        return sum(object.polygon.area for object in chain(self.rooms, self.walls))
 
-        for room in self.rooms:
-            area += room.polygon.area
+    def wall_pairs(self):
+        """Returns a list of pairs of walls whose bounding boxes intersect, ordered by wall index."""
+        index = PlanObjectIndex(self.walls)
+        pairs = []
 
-        for wall in self.walls:
-            area += wall.polygon.area
+        for this_wall in self.walls:
+            for that_wall in index.query(this_wall.polygon):
+                if this_wall.index < that_wall.index:
+                    pairs.append((this_wall, that_wall))
 
-        return area
+        return pairs
 
     def remove_wall_overlaps(self):
         """Adjusts walls in the model so none of them overlap."""
-        pairs = list(combinations(self.walls, 2))
+
+        # Differencing only ever shrinks a wall, so pairs whose bounding boxes are disjoint now will stay that way
+        pairs = self.wall_pairs()
         pairs_to_retry = []
 
         while True:
+            changed = False
 
             # Any pairs that can't be differenced cleanly go into pairs_to_retry
             for this_wall, that_wall in pairs:
-                if this_wall.remove_overlaps(that_wall) == False:
+                this_polygon, that_polygon = this_wall.polygon, that_wall.polygon
+                if not this_wall.remove_overlaps(that_wall):
                     pairs_to_retry.append((this_wall, that_wall))
+                elif this_wall.polygon is not this_polygon or that_wall.polygon is not that_polygon:
+                    changed = True
 
             # If there are no pairs to retry, we're done
             if len(pairs_to_retry) == 0:
                 return
 
-            # If we have just as many pairs to retry as we started with, exit the loop
-            if len(pairs_to_retry) == len(pairs):
+            # If no walls changed, the pairs to retry would just fail the same way again, so exit the loop
+            if not changed:
                 break
 
             # Go again
@@ -679,18 +799,30 @@ class Floor:
 
     def find_adjacencies(self):
         self.remove_wall_overlaps()
-        for room_index, room in enumerate(self.rooms):
-            room.find_adjacencies(self.walls)
-            room.find_adjacencies(self.railings)
-            room.find_adjacencies(self.rooms[room_index+1:])
+        walls = PlanObjectIndex(self.walls)
+        railings = PlanObjectIndex(self.railings)
+        rooms = PlanObjectIndex(self.rooms)
+
+        # Objects can only be adjacent if their bounding boxes come within the tolerance of each other
+        for room in self.rooms:
+            room.find_adjacencies(walls.query(room.polygon, CLOSE_EDGE_TOLERANCE))
+            room.find_adjacencies(railings.query(room.polygon, CLOSE_EDGE_TOLERANCE))
+            room.find_adjacencies([r for r in rooms.query(room.polygon, CLOSE_EDGE_TOLERANCE) if r.index > room.index])
 
     def find_inside(self):
+        index = PlanObjectIndex(self.rooms)
+
+        # Only rooms whose bounding boxes intersect a fixture can contain it
         for fixture in self.fixtures:
-            fixture.find_rooms(self.rooms)
+            fixture.find_rooms(index.query(fixture.polygon))
 
 
 
 
+def apply_to_model(cubicasa, fn, path):
+    return fn(cubicasa.get_model(*path))
+
+
 class Cubicasa:
 
     def __init__(self, basepath):
@@ -698,20 +830,21 @@ class Cubicasa:
 
     def get_model(self, *path):
         model_path = os.path.join(self.basepath, *path, "model.svg")
-        with open(model_path) as file:
-            contents = file.read()
+
+        # Clean up the memory-mapped file directly, rather than reading it into a str first
+        with open(model_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as source:
 
             # Strip out all id attributes
-            contents = re.sub(id_pattern, " ", contents)
+            contents = id_pattern.sub(b" ", source)
 
             # Strip out all "display: none" styles -- they cause svgelements to ignore
-            contents = re.sub(display_none_pattern, " ", contents)
+            contents = display_none_pattern.sub(b" ", contents)
 
             # Some models have invalid <path> data that causes svgelements to ignore the affected elements
             # See high_quality_architectural/10074/model.svg for examples
-            contents = contents.replace("LNaN,NaN", "")
+            contents = contents.replace(b"LNaN,NaN", b"")
 
-            model = Model(StringIO(contents))
+            model = Model(BytesIO(contents))
             model.path = model_path
             return model
 
@@ -737,3 +870,14 @@ class Cubicasa:
 
             else:
                 break
+
+    def map_models(self, fn, limit=None, offset=0, workers=None):
+        """Applies fn to each model in a pool of worker processes, yielding the results in the same order as models().
+
+        Both fn and its results are sent between processes, so they must be picklable.
+        """
+        stop = None if limit is None else offset + limit
+        paths = islice(self.paths(), offset, stop)
+
+        with ProcessPoolExecutor(workers) as executor:
+            yield from executor.map(partial(apply_to_model, self, fn), paths)
@@ -122,36 +122,46 @@ def process(model):
                 yield data
 
     except Exception as e:
-        print("Error when processing {}".format(m.path), file=sys.stderr)
+        print("Error when processing {}".format(model.path), file=sys.stderr)
         raise
 
+def process_all(model):
+    """Returns every row for the model as a list, so the rows can be sent back from a worker process."""
+    return list(process(model))
 
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("basepath", metavar="CUBICASA_PATH", help="The path to the cubicasa5k folder")
-parser.add_argument("-l", "--limit", type=int, help="The maximum number of plans to process")
-parser.add_argument("-o", "--offset", type=int, help="The number of plans to skip before processing", default=0)
-parser.add_argument("-p", "--plan", help="The relative path to a specific plan to process")
-args = parser.parse_args()
 
-start_time = perf_counter()
-c = Cubicasa(args.basepath)
-w = csv.DictWriter(sys.stdout, fieldnames=get_headers())
-w.writeheader()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("basepath", metavar="CUBICASA_PATH", help="The path to the cubicasa5k folder")
+    parser.add_argument("-l", "--limit", type=int, help="The maximum number of plans to process")
+    parser.add_argument("-o", "--offset", type=int, help="The number of plans to skip before processing", default=0)
+    parser.add_argument("-p", "--plan", help="The relative path to a specific plan to process")
+    parser.add_argument("-j", "--jobs", type=int, help="The number of worker processes to use when processing multiple plans")
+    args = parser.parse_args()
 
-if args.plan is not None:
-    m = c.get_model(args.plan)
-    for data in process(m):
-        w.writerow(data)
+    start_time = perf_counter()
+    c = Cubicasa(args.basepath)
+    w = csv.DictWriter(sys.stdout, fieldnames=get_headers())
+    w.writeheader()
 
-else:
-    for m in c.models(args.limit, args.offset):
+    if args.plan is not None:
+        m = c.get_model(args.plan)
         for data in process(m):
             w.writerow(data)
 
+    elif args.jobs is not None:
+        for rows in c.map_models(process_all, args.limit, args.offset, args.jobs):
+            w.writerows(rows)
 
-elapsed = perf_counter() - start_time
-minutes = int(elapsed // 60)
-seconds = elapsed % 60
-print("Completed in {:02d}:{:07.4f}".format(minutes, seconds), file=sys.stderr)
+    else:
+        for m in c.models(args.limit, args.offset):
+            for data in process(m):
+                w.writerow(data)
+
+
+    elapsed = perf_counter() - start_time
+    minutes = int(elapsed // 60)
+    seconds = elapsed % 60
+    print("Completed in {:02d}:{:07.4f}".format(minutes, seconds), file=sys.stderr)